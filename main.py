@@ -2,16 +2,18 @@
 # Authors: Batyrkhan Baimukhanov, Dimitrios Zorbas, Aruzhan Sabyrbek
 # Licensed under GNU GPL v3 (https://www.gnu.org/licenses/gpl-3.0.en.html)
 
+import gc
 import os
 import time
-import random
+import struct
 import _thread
+import micropython
 import ssd1306
 from sx1262 import SX1262
-from hashlib import sha256
-from binascii import hexlify
+from binascii import crc32
+from collections import deque
 from micropython import const
-from machine import SoftI2C, Pin, Timer, I2C
+from machine import Pin, Timer, I2C
 
 # Packet type codings
 BEACON = const(1)
@@ -21,6 +23,10 @@ TEXT_MESSAGE = const(4)
 REQUEST_PREV_MSG = const(5)
 REPLY_PREV_MSG = const(6)
 
+# set to 1 to print diagnostics; with 0 the compiler drops every
+# "if DEBUG:" block from the bytecode
+DEBUG = const(0)
+
 # OLED colors
 OFF = 0x000000
 RED = 0xFF0000
@@ -29,16 +35,40 @@ BLUE = 0x0000FF
 WHITE = 0xFFFAFA
 YELLOW = 0xFFFF00
 
-messages = []
-message_ids = []
+# fixed size ring buffers; appending to a full one drops the oldest item
+MAX_STORED_MSGS = const(100)
+messages = deque((), MAX_STORED_MSGS)
+message_ids = deque((), MAX_STORED_MSGS)
 lock = _thread.allocate_lock()
 tim = Timer(0)
+beacon_tim = Timer(1)
+# kept open for the whole run; flushed every LOG_FLUSH_EVERY writes, so up
+# to LOG_FLUSH_EVERY - 1 forwarded-packet lines are lost on reset or power loss
+log_file = open("logs.txt", "a")
+LOG_FLUSH_EVERY = const(8)
+num_log_writes = 0
+
+# ring log of the last notable events as (time, event) tuples, kept for
+# post-mortem inspection from the REPL when DEBUG prints are off
+event_log = deque((), 64)
+
+def log_event(event):
+    event_log.append((time.time(), event))
 
 def generate_mac_address():
-    digits = [random.choice('0123456789ABCDEF') for _ in range(6)]
-    mac_address = ''.join(digits)
-    
-    return mac_address
+    return os.urandom(6)
+
+# parses a nbr set packet into the sender's mac address and its
+# two_hop_neighbors_info; compiled to native code as it runs per packet
+@micropython.native
+def parse_nbr_set(recv_pkg):
+    first_hop_neighbor_id = bytes(recv_pkg[1:7])
+    two_hop_neighbors = {}
+    two_hop_neighbors[first_hop_neighbor_id] = 0
+    for i in range(7, len(recv_pkg) - 6, 7):
+        nbr_mac, nbr_rssi = struct.unpack_from("6sB", recv_pkg, i)
+        two_hop_neighbors[nbr_mac] = -nbr_rssi
+    return first_hop_neighbor_id, two_hop_neighbors
 
 #************************************
 #                                   *
@@ -52,20 +82,40 @@ rst.value(1)
 time.sleep_ms(5)
 scl = Pin(18, Pin.OUT, Pin.PULL_UP)
 sda = Pin(17, Pin.OUT, Pin.PULL_UP)
-i2c = SoftI2C(scl=scl, sda=sda)
+i2c = I2C(0, scl=scl, sda=sda, freq=1_000_000)
 oled = ssd1306.SSD1306_I2C(128, 64, i2c)
+oled.hline(0, 53, 127,1)
+
+# y of each text line on the screen and the text currently drawn there;
+# only the pages of lines whose text changed are sent to the display
+SCREEN_ROWS = (0, 10, 20, 30, 40, 56)
+screen_lines = [None] * len(SCREEN_ROWS)
 
 def show_on_screen(msg, cds=None):
-    oled.fill(0)
-    oled.text("LoRa Mesh CDS", 0, 0)
     if cds:
-        oled.text(f"Dominant: {'yes' if cds.is_dominator else 'no'}", 0, 10)
-        oled.text(f"Nbrs: {len(cds.nbrs_dict)}", 0, 20)
-        oled.text(f"Sent pkts: {num_sent_pkts}", 0, 30)
-        oled.text(f"Rcvd pkts: {num_rcvd_pkts}", 0, 40)
-    oled.hline(0, 53, 127,1)
-    oled.text(msg, 0, 56)
-    oled.show()
+        lines = ("LoRa Mesh CDS",
+                 f"Dominant: {'yes' if cds.is_dominator else 'no'}",
+                 f"Nbrs: {len(cds.nbrs_dict)}",
+                 f"Sent pkts: {num_sent_pkts}",
+                 f"Rcvd pkts: {num_rcvd_pkts}",
+                 msg)
+    else:
+        lines = ("LoRa Mesh CDS", "", "", "", "", msg)
+
+    first_page = oled.pages
+    last_page = -1
+    for k in range(len(SCREEN_ROWS)):
+        if lines[k] == screen_lines[k]:
+            continue
+        y = SCREEN_ROWS[k]
+        oled.fill_rect(0, y, oled.width, 8, 0)
+        oled.text(lines[k], 0, y)
+        screen_lines[k] = lines[k]
+        first_page = min(first_page, y // 8)
+        last_page = max(last_page, (y + 7) // 8)
+
+    if last_page >= 0:
+        oled.show(first_page, last_page)
     
 show_on_screen("Starting...", None)
 
@@ -90,8 +140,15 @@ BUSY = 13
 lora = SX1262(1, SCK, MOSI, MISO, CS, RX, RST, BUSY)
 lora.begin(freq=868.5, bw=125.0, sf=7)
 
+# received packets are read into this buffer; handlers get a memoryview
+# of it and must copy out whatever they keep after returning
+rx_buf = bytearray(255)
+
 num_sent_pkts = 0
 num_rcvd_pkts = 0
+# mirrors cds.is_dominator for the packet forwarding path; updated by the
+# CDS object whenever it decides its dominance state
+node_is_dominant = 0
 
 #************************************
 #                                   *
@@ -104,6 +161,7 @@ num_rcvd_pkts = 0
 #   nbr(s) - neighbor(s)
 
 # Public functions:
+#   start_beacons()
 #   send_beacon()
 #   process_beacon()
 #   process_neighbor_set()
@@ -114,8 +172,12 @@ num_rcvd_pkts = 0
 #  __enter_nbr_discovery_state()
 #  __exit_nbr_discovery_state_alarm()
 #  __send_nbr_set()
+#  __schedule_next_beacon()
+#  __beacon_alarm()
 #  __check_leavers_alarm()
 #  __check_dominance_alarm()
+#  __refresh_dom_display()
+#  __finish_dominance()
 #  __check_dominance()
 
 # CONST values used (ssimply any integer):
@@ -127,10 +189,10 @@ num_rcvd_pkts = 0
 # arguments a LoRa socket through which the object will send packets and
 # a LoRa object through which the CDS object can access RSSI values.
 
-# After that, the user is expected to call cds_object.send_beacon() repeatedly
-# in an infinite loop at one of the threads. Take note that send_beacon()
-# will put its thread to sleep for a random amount of time and only then
-# the node will send out the beacon.
+# After that, the user is expected to call cds_object.start_beacons() once.
+# The node then sends out a beacon after a random delay, re-arming a one-shot
+# timer (beacon_tim) for the next one each time, so no thread has to sleep
+# between beacons.
 
 # Upon receiving any LoRa packet, the user should check the first byte for
 # such flags as BEACON, NEIGHBOR_SET, and UPD_NEIGHBOR_SET; and then call
@@ -152,6 +214,8 @@ num_rcvd_pkts = 0
 #     nbr_mac_addr_3 : [...],
 #     ...
 # }
+# the list items are accessed by the LAST_SEEN, TWO_HOP, DOM_STATE and
+# AVG_RSSI indices below
 
 # * two_hop_neighbors_info = {
 #     nbr_mac_addr : 0 (RSS value),
@@ -160,6 +224,12 @@ num_rcvd_pkts = 0
 #     ...
 # }
 
+LAST_SEEN = const(0)
+TWO_HOP = const(1)
+DOM_STATE = const(2)
+AVG_RSSI = const(3)
+
+
 class CDS:
     def __init__(self, lora):
         self.lora = lora
@@ -167,11 +237,28 @@ class CDS:
         self.is_dominator = 0
         self.nbrs_dict = {}
         self.dominant_nbrs_set = set()
+        # guards nbrs_dict and the counters derived from it; it is held
+        # only while reading or updating them, never across a send or a
+        # dominance check, so it is never acquired twice by one thread
+        self._cds_lock = _thread.allocate_lock()
         self.beacon_max_delay = 5
         self.beacon_min_delay = 1
         self.nbr_discovery_state = True
         self.alarm_check_leavers = None
         self.alarm_check_dominance = None
+        self._last_displayed_dom = None
+        # number of nbrs in nbrs_dict whose two-hop info is still None
+        self._nbrs_awaiting_info = 0
+        # bumped whenever the input of the dominance check changes (nbrs
+        # joining or leaving, their two-hop sets or dominance states);
+        # the check is skipped if nothing changed since its last run
+        self._nbrs_epoch = 0
+        self._last_dom_epoch = -1
+        # beacon packet is reused on every send; only the dominance
+        # state byte changes
+        self._beacon_buf = bytearray(1 + 6 + 1)
+        self._beacon_buf[0] = BEACON
+        self._beacon_buf[1:7] = self.mac_addr
 
         self.__enter_nbr_discovery_state(delay_s=60, first_time=True)
 
@@ -181,10 +268,11 @@ class CDS:
 
 
     def __enter_nbr_discovery_state(self, delay_s, first_time):
-        if first_time:
-            print("entering nbr discovery state for the first time")
-        else:
-            print("entering nbr discovery state again")
+        if DEBUG:
+            if first_time:
+                print("entering nbr discovery state for the first time")
+            else:
+                print("entering nbr discovery state again")
 
         self.nbr_discovery_state = True
         self.beacon_min_delay = 5
@@ -193,10 +281,11 @@ class CDS:
 
 
     def __exit_nbr_discovery_state_alarm(self, first_time):
-        if first_time:
-            print("exiting nbr discovery state for the first time")
-        else:
-            print("exiting nbr discovery state again")
+        if DEBUG:
+            if first_time:
+                print("exiting nbr discovery state for the first time")
+            else:
+                print("exiting nbr discovery state again")
         self.nbr_discovery_state = False
         if not self.alarm_check_leavers:
             self.alarm_check_leavers = tim.init(period=120 * 1000, mode=Timer.PERIODIC, callback=self.__check_leavers_alarm )
@@ -211,18 +300,24 @@ class CDS:
 
 
     def __send_nbr_set(self, packet_type):
-        if packet_type == NEIGHBOR_SET:
-            print("ALARM: broadcasting my neighbors with type NEIGHBOR_SET")
-            show_on_screen("sent nbrs_set", self)
-        else:
-            print("ALARM: broadcasting my neighbors with type UPD_NEIGHBOR_SET")
-            show_on_screen("sent nbrs_set", self)
-        packet = bytes([packet_type]) + self.mac_addr
-        for nbr_mac in self.nbrs_dict.keys():
-            packet += nbr_mac
-            # 1 byte for rssi; from negative float to positive int
-            packet += bytes([-int(self.nbrs_dict[nbr_mac][3])])
-        print(packet)
+        if DEBUG:
+            if packet_type == NEIGHBOR_SET:
+                print("ALARM: broadcasting my neighbors with type NEIGHBOR_SET")
+            else:
+                print("ALARM: broadcasting my neighbors with type UPD_NEIGHBOR_SET")
+        show_on_screen("sent nbrs_set", self)
+        with self._cds_lock:
+            packet = bytearray(1 + 6 + 7 * len(self.nbrs_dict))
+            packet[0] = packet_type
+            packet[1:7] = self.mac_addr
+            offset = 7
+            for nbr_mac, nbr_info in self.nbrs_dict.items():
+                packet[offset:offset + 6] = nbr_mac
+                # 1 byte for rssi; from negative float to positive int
+                packet[offset + 6] = -int(nbr_info[AVG_RSSI]) & 0xFF
+                offset += 7
+        if DEBUG:
+            print(packet)
         # packet = [2 or 3, my_mac, nbr_mac, rssi, nbr_mac, rssi, ... ]
         self.lora_send(packet)
 
@@ -231,139 +326,169 @@ class CDS:
         if self.nbr_discovery_state:
             return
 
-        print("ALARM: checking leavers")
+        if DEBUG:
+            print("ALARM: checking leavers")
         show_on_screen("checking leavers", self)
 
-        did_delete_neighbor = False
-
-        for id in self.nbrs_dict.keys():
-            # if neighbor did not send beacon for more
-            # than 2 min, then consider it out of range/off
-            if self.nbrs_dict[id][0] + 120 < time.time():
-                print("neighbor with id:", id, "disconnected")
+        # if neighbor did not send beacon for more
+        # than 2 min, then consider it out of range/off;
+        # expired ids are collected first because nbrs_dict
+        # cannot change size while it is being iterated
+        now = time.time()
+        with self._cds_lock:
+            expired = [id for id, nbr_info in self.nbrs_dict.items()
+                       if nbr_info[LAST_SEEN] + 120 < now]
+            for id in expired:
+                if self.nbrs_dict[id][TWO_HOP] is None:
+                    self._nbrs_awaiting_info -= 1
                 del self.nbrs_dict[id]
-                did_delete_neighbor = True
-                # neighbor set changed, so notify neighbors about the changes
-                self.__send_nbr_set(UPD_NEIGHBOR_SET)
+            if expired:
+                self._nbrs_epoch += 1
+        for id in expired:
+            log_event("nbr disconnected")
+            if DEBUG:
+                print("neighbor with id:", id, "disconnected")
+        did_delete_neighbor = bool(expired)
+
+        # neighbor set changed, so notify neighbors about the changes
+        if did_delete_neighbor:
+            self.__send_nbr_set(UPD_NEIGHBOR_SET)
 
         # if someone disconnected, only dominant nbrs might change their
         # dominance state, it does not affect non-dominant nbrs
         if (self.is_dominator and
                 did_delete_neighbor and
                 self.alarm_check_dominance == None):
-            print("nbr disconnected, setting alarm to check dominance")
+            if DEBUG:
+                print("nbr disconnected, setting alarm to check dominance")
             self.alarm_check_dominance = tim.init(period=60 * 1000, mode=Timer.ONE_SHOT, callback=self.__check_dominance_alarm )
 
         if not did_delete_neighbor:
-            print("no one left")
+            if DEBUG:
+                print("no one left")
 
 
     def __check_dominance_alarm(self, timer):
         self.alarm_check_dominance = None
-        print("ALARM: delayed dominance check")
+        if DEBUG:
+            print("ALARM: delayed dominance check")
         self.__check_dominance()
 
 
+    # redraws the screen only when the dominance state differs from the
+    # one shown last time, to avoid a full framebuffer push over I2C
+    def __refresh_dom_display(self):
+        if self.is_dominator == self._last_displayed_dom:
+            return
+        self._last_displayed_dom = self.is_dominator
+        if self.is_dominator:
+            show_on_screen("I am dominant", self)
+        else:
+            show_on_screen("Not dominant", self)
+
+
+    # common exit of the dominance check: stores the decision, announces
+    # it with a beacon, and updates the screen
+    def __finish_dominance(self, is_dom, reason):
+        global node_is_dominant
+        self.is_dominator = is_dom
+        node_is_dominant = is_dom
+        log_event(reason)
+        if DEBUG:
+            print(reason)
+        self._beacon_buf[7] = is_dom
+        self.lora_send(self._beacon_buf)
+        if DEBUG:
+            print("sent beacon")
+        self.__refresh_dom_display()
+        # the decision is done; collect now rather than in the middle of
+        # the next packet handler
+        gc.collect()
+
+
     def __check_dominance(self):
-        print("checking dominance")
-        num_of_nbrs = len(self.nbrs_dict)
+        # snapshot nbrs_dict into parallel lists so that the loops below
+        # run without holding the lock and index by integer instead of
+        # repeatedly hashing mac addresses
+        with self._cds_lock:
+            # some nbr has not sent its nbr set yet; deciding on partial
+            # data could announce a wrong state, so wait for it
+            if self._nbrs_awaiting_info:
+                if DEBUG:
+                    print("missing nbr sets, skipping dominance check")
+                return
+            if self._nbrs_epoch == self._last_dom_epoch:
+                if DEBUG:
+                    print("nbrs unchanged, skipping dominance check")
+                return
+            self._last_dom_epoch = self._nbrs_epoch
+            items = list(self.nbrs_dict.items())
+            macs = [nbr_mac for nbr_mac, _ in items]
+            adj = [nbr_info[TWO_HOP] for _, nbr_info in items]
+            dom = [nbr_info[DOM_STATE] for _, nbr_info in items]
+            rssi = [nbr_info[AVG_RSSI] for _, nbr_info in items]
+        if DEBUG:
+            print("checking dominance")
+        num_of_nbrs = len(macs)
+
+        # nbr sets of my nbrs, built once for the set tests below
+        nbr_sets = [frozenset(two_hop) for two_hop in adj]
+
+        my_nbr_set = set(macs)
+        my_nbr_set.add(self.mac_addr)
+        my_rssi_sum = sum(rssi)
+
         # case if I have only 1 nbr
         if num_of_nbrs == 1:
-            single_nbr_info = next(iter(self.nbrs_dict.values()))
             # if my single nbr is already dominant, then I am not dominant
-            if single_nbr_info[2]:
-                self.is_dominator = 0
-                print("Not dominant between the two")
-                packet = bytes([BEACON]) + self.mac_addr + bytes([0])
-                self.lora_send(packet)
-                print("sent beacon")
-                return
+            if dom[0]:
+                return self.__finish_dominance(0, "Not dominant between the two")
 
             # if my single nbr is not dominant yet and it is only two of us,
             # then I proclaim myself dominant
-            if len(single_nbr_info[1]) == 2:
-                self.is_dominator = 1
-                print("I am dominant between the two")
-                packet = bytes([BEACON]) + self.mac_addr + bytes([1])
-                self.lora_send(packet)
-                print("sent beacon")
-                show_on_screen("I am dominant", self)
-                return
+            if len(adj[0]) == 2:
+                return self.__finish_dominance(1, "I am dominant between the two")
             # if my single nbr has other nbrs, then I am an edge node and
             # not dominant
             else:
-                self.is_dominator = 0
-                print("Not dominant between two because I am edge node")
-                packet = bytes([BEACON]) + self.mac_addr + bytes([0])
-                self.lora_send(packet)
-                print("sent beacon")
-                return
+                return self.__finish_dominance(0, "Not dominant between two because I am edge node")
 
         # if I have 2 or more nbrs, then check their connectivity
-        for id1 in self.nbrs_dict.keys():
-            for id2 in self.nbrs_dict.keys():
-                if id1 == id2:
+        for i in range(num_of_nbrs):
+            for j in range(num_of_nbrs):
+                if i == j:
                     continue
 
                 # if two nbrs disconnected, then check whether there is
                 # a third nbr that connects those two to determine who should
                 # be dominant
-                if id1 not in self.nbrs_dict[id2][1].keys():
-                    for id3 in self.nbrs_dict.keys():
-                        if id3 == id1 or id3 == id2:
+                if macs[i] not in nbr_sets[j]:
+                    pair = {macs[i], macs[j]}
+                    for k in range(num_of_nbrs):
+                        if k == i or k == j:
                             continue
-                        if id1 not in self.nbrs_dict[id3][1].keys():
-                            continue
-                        if id2 not in self.nbrs_dict[id3][1].keys():
+                        if not pair <= nbr_sets[k]:
                             continue
                         # if here, then there is a third nbr that connects
                         # two previous nbrs; need to check whether me or the
                         # third nbr should be dominant
-                        my_nbr_set = set(self.nbrs_dict.keys())
-                        my_nbr_set.add(self.mac_addr)
-                        third_nbr_nbr_set = set(self.nbrs_dict[id3][1].keys())
+                        third_nbr_nbr_set = nbr_sets[k]
 
                         # if my nbr set is a superset, then I should be dominant
                         if my_nbr_set > third_nbr_nbr_set:
-                            self.is_dominator = 1
-                            print("I am dominant because I connect two nbrs and am superset")
-                            packet = bytes([BEACON]) + self.mac_addr + bytes([1])
-                            self.lora_send(packet)
-                            print("sent beacon")
-                            show_on_screen("I am dominant", self)
-                            return
+                            return self.__finish_dominance(1, "I am dominant because I connect two nbrs and am superset")
                         # if my nbr set is a subset, then I shouldn't be dominant
                         elif my_nbr_set < third_nbr_nbr_set:
-                            self.is_dominator = 0
-                            packet = bytes([BEACON]) + self.mac_addr + bytes([0])
-                            self.lora_send(packet)
-                            print("sent beacon")
-                            print("Not dominant because I am a subset")
-                            return
+                            return self.__finish_dominance(0, "Not dominant because I am a subset")
                         elif my_nbr_set == third_nbr_nbr_set:
                             # if me and the third have the same nbr sets, then
                             # we resolve dominance based on the sum of rssi's
-                            my_rssi_sum = 0
-                            for nbr_info in self.nbrs_dict.values():
-                                my_rssi_sum += nbr_info[3]
-
-                            third_nbr_rssi_sum = sum(self.nbrs_dict[id3][1].values())
+                            third_nbr_rssi_sum = sum(adj[k].values())
 
                             if my_rssi_sum > third_nbr_rssi_sum:
-                                self.is_dominator = 1
-                                print("I am dominant because I connect 2 nbrs and have better RSSI")
-                                packet = bytes([BEACON]) + self.mac_addr + bytes([1])
-                                self.lora_send(packet)
-                                print("sent beacon")
-                                show_on_screen("I am dominant", self)
-                                return
+                                return self.__finish_dominance(1, "I am dominant because I connect 2 nbrs and have better RSSI")
                             else:
-                                self.is_dominator = 0
-                                print("Not dominant because I have worse RSSI")
-                                packet = bytes([BEACON]) + self.mac_addr + bytes([0])
-                                self.lora_send(packet)
-                                print("sent beacon")
-                                return
+                                return self.__finish_dominance(0, "Not dominant because I have worse RSSI")
                         else:
                             # two sets are not equal, nor are subsets of each
                             # other; this means that each one of them has such
@@ -377,78 +502,66 @@ class CDS:
                             # both, 1 and 2, connect 3 and 4; but 1 also
                             # connects 2 and 5, and 2 also connects 1 and 6;
                             # therefore, both should be dominant
-                            self.is_dominator = 1
-                            print("I am dominant because I connect 2 nbrs and am not super, sub, or equal")
-                            packet = bytes([BEACON]) + self.mac_addr + bytes([1])
-                            self.lora_send(packet)
-                            print("sent beacon")
-                            show_on_screen("I am dominant", self)
-                            return
+                            return self.__finish_dominance(1, "I am dominant because I connect 2 nbrs and am not super, sub, or equal")
 
                     # if here, then there is no third nbr that connects
                     # two previous nbrs, meaning that I need to be
                     # dominant
-                    self.is_dominator = 1
-                    print("I am dominant because only I connect 2 nbrs")
-                    packet = bytes([BEACON]) + self.mac_addr + bytes([1])
-                    self.lora_send(packet)
-                    print("sent beacon")
-                    show_on_screen("I am dominant", self)
-                    return
+                    return self.__finish_dominance(1, "I am dominant because only I connect 2 nbrs")
 
         # if here, then all nbrs are connected; need to check whether
         # there is already a dominant node or some node has other edges
         # outside our clique
-        for nbr_info in self.nbrs_dict.values():
-            if (len(nbr_info[1]) > num_of_nbrs + 1 or
-                    nbr_info[2]):
-                self.is_dominator = 0
-                print('''Not dominant because it's clique and some nbr
+        for k in range(num_of_nbrs):
+            if (len(adj[k]) > num_of_nbrs + 1 or
+                    dom[k]):
+                return self.__finish_dominance(0, '''Not dominant because it's clique and some nbr
                     is cut vertex or because its complete graph and
                     some nbr is already dominant''')
-                packet = bytes([BEACON]) + self.mac_addr + bytes([0])
-                self.lora_send(packet)
-                print("sent beacon")
-                return
 
         # if here, then we have a complete graph with no dominant
         # nodes yet; dominance is resolved based on the sum of rssi's
-        my_rssi_sum = 0
-        for nbr_info in self.nbrs_dict.values():
-            my_rssi_sum += nbr_info[3]
-
-        for id in self.nbrs_dict.keys():
-            if my_rssi_sum < sum(self.nbrs_dict[id][1].values()):
-                self.is_dominator = 0
-                print("Not dominant in complete graph because of worse RSSI")
-                packet = bytes([BEACON]) + self.mac_addr + bytes([0])
-                self.lora_send(packet)
-                print("sent beacon")
-                return
+        for k in range(num_of_nbrs):
+            if my_rssi_sum < sum(adj[k].values()):
+                return self.__finish_dominance(0, "Not dominant in complete graph because of worse RSSI")
 
         # if here, in the complete graph I have the best connectivity
         # to others, so I should be dominant
-        self.is_dominator = 1
-        print("I am dominant in complete graph because off high RSSI")
-        packet = bytes([BEACON]) + self.mac_addr + bytes([1])
-        self.lora_send(packet)
-        print("sent beacon")
-        show_on_screen("I am dominant", self)
-        return
+        return self.__finish_dominance(1, "I am dominant in complete graph because off high RSSI")
+
+
+    # starts the periodic beaconing driven by beacon_tim
+    def start_beacons(self):
+        self.__schedule_next_beacon()
 
 
-    # beacon interval is randomized between lower and upper boundaries
     def send_beacon(self):
+        self._beacon_buf[7] = self.is_dominator
+        self.lora_send(self._beacon_buf)
+        if DEBUG:
+            print(f"sent beacon {self._beacon_buf}")
+        show_on_screen("sent beacon", self)
+        # nothing else happens until the next beacon, so this is a quiet
+        # point to collect garbage
+        gc.collect()
+
+
+    # beacon interval is randomized between lower and upper boundaries,
+    # plus a fixed 3 s gap
+    def __schedule_next_beacon(self):
         r = os.urandom(1)
         r = int.from_bytes(r, "big") / 255
         r = (r * (self.beacon_max_delay - self.beacon_min_delay) +
-            self.beacon_min_delay)
-        time.sleep(r)
+            self.beacon_min_delay + 3)
+        beacon_tim.init(period=int(r * 1000), mode=Timer.ONE_SHOT, callback=self.__beacon_alarm)
 
-        packet = bytes([BEACON]) + self.mac_addr + bytes([self.is_dominator])
-        self.lora_send(packet)
-        print(f"sent beacon {packet}")
-        show_on_screen("sent beacon", self)
+
+    # machine.Timer callbacks already run from the scheduler on ESP32, so
+    # the beacon is sent right here; the timer is re-armed first so that a
+    # failing send cannot stop beaconing
+    def __beacon_alarm(self, timer):
+        self.__schedule_next_beacon()
+        self.send_beacon()
 
 
     # upon receiving the beacon packet, the node pulls out nbr mac address,
@@ -458,24 +571,33 @@ class CDS:
     # nbr discovery state, then the node reenters the state, which may lead
     # to CDS update.
     def process_beacon(self, recv_pkg):
-        print("\nreceived beacon:", recv_pkg)
+        if DEBUG:
+            print("\nreceived beacon:", bytes(recv_pkg))
         
         nbr_rssi = self.lora.getRSSI()
-        nbr_mac_addr = recv_pkg[1:7]
+        nbr_mac_addr = bytes(recv_pkg[1:7])
         is_nbr_dominant = recv_pkg[7]
-        if is_nbr_dominant:
-            self.dominant_nbrs_set.add(nbr_mac_addr)
-        else:
-            self.dominant_nbrs_set.discard(nbr_mac_addr)
-        if nbr_mac_addr in self.nbrs_dict:
-            self.nbrs_dict[nbr_mac_addr][0] = time.time()
-            self.nbrs_dict[nbr_mac_addr][2] = is_nbr_dominant
-            # exponential weighted moving average; alpha = 0.3
-            self.nbrs_dict[nbr_mac_addr][3] = (0.7 * self.nbrs_dict[nbr_mac_addr][3] +
-                                               0.3 * nbr_rssi)
-        else:
-            self.nbrs_dict[nbr_mac_addr] = [time.time(), None, is_nbr_dominant, nbr_rssi]
-            print("got new nbr:", nbr_mac_addr)
+        with self._cds_lock:
+            if is_nbr_dominant:
+                self.dominant_nbrs_set.add(nbr_mac_addr)
+            else:
+                self.dominant_nbrs_set.discard(nbr_mac_addr)
+            nbr_info = self.nbrs_dict.get(nbr_mac_addr)
+            if nbr_info is not None:
+                nbr_info[LAST_SEEN] = time.time()
+                if nbr_info[DOM_STATE] != is_nbr_dominant:
+                    self._nbrs_epoch += 1
+                nbr_info[DOM_STATE] = is_nbr_dominant
+                # exponential weighted moving average; alpha = 0.3
+                nbr_info[AVG_RSSI] = 0.7 * nbr_info[AVG_RSSI] + 0.3 * nbr_rssi
+            else:
+                self.nbrs_dict[nbr_mac_addr] = [time.time(), None, is_nbr_dominant, nbr_rssi]
+                self._nbrs_awaiting_info += 1
+                self._nbrs_epoch += 1
+        if nbr_info is None:
+            log_event("got new nbr")
+            if DEBUG:
+                print("got new nbr:", nbr_mac_addr)
             # if I receive a new beacon after neighbor discovery
             # state, then I need to reenter the state and broadcast
             # my updated neighborhood list
@@ -485,41 +607,50 @@ class CDS:
                 self.__enter_nbr_discovery_state(delay_s=30 + r * 10, first_time=False)
 
         show_on_screen("rcvd beacon", self)
-        print("\nneighbors:")
-        for n in self.nbrs_dict.keys():
-            print(n, ":", self.nbrs_dict[n])
+        if DEBUG:
+            print("\nneighbors:")
+            for n in self.nbrs_dict.keys():
+                print(n, ":", self.nbrs_dict[n])
 
 
     def process_neighbor_set(self, recv_pkg):
-        print("got neighbor set:", recv_pkg)
+        if DEBUG:
+            print("got neighbor set:", bytes(recv_pkg))
         show_on_screen("rcvd nbrs_set", self)
         # structure of received packet:
         # [2, 1st_hop_nbr_mac, 2nd_hop_nbr_mac, rssi, 2nd_hop_nbr_mac, rssi, ... ]
 
         packet_type = recv_pkg[0]
-        if packet_type == NEIGHBOR_SET:
-            print("with type NEIGHBOR_SET")
-        else:
-            print("with type UPD_NEIGHBOR_SET")
-        first_hop_neighbor_id = recv_pkg[1:7]
-
-        two_hop_neighbors = {}
-        two_hop_neighbors[first_hop_neighbor_id] = 0
-        for i in range(7, len(recv_pkg), 7):
-            two_hop_neighbors[recv_pkg[i:i+6]] = -recv_pkg[i+6]
+        if DEBUG:
+            if packet_type == NEIGHBOR_SET:
+                print("with type NEIGHBOR_SET")
+            else:
+                print("with type UPD_NEIGHBOR_SET")
+        first_hop_neighbor_id, two_hop_neighbors = parse_nbr_set(recv_pkg)
 
         #two_hop_neighbors = [ recv_pkg[i:i+6] for i in range(1, len(recv_pkg), 6)]
-        print("two_hop_neighbors:", two_hop_neighbors, "\n")
-        self.nbrs_dict[first_hop_neighbor_id][1] = two_hop_neighbors
+        if DEBUG:
+            print("two_hop_neighbors:", two_hop_neighbors, "\n")
+        with self._cds_lock:
+            first_hop_neighbor_info = self.nbrs_dict[first_hop_neighbor_id]
+            old_two_hop_neighbors = first_hop_neighbor_info[TWO_HOP]
+            if old_two_hop_neighbors is None:
+                self._nbrs_awaiting_info -= 1
+                self._nbrs_epoch += 1
+            elif (len(old_two_hop_neighbors) != len(two_hop_neighbors) or
+                    any(m not in old_two_hop_neighbors for m in two_hop_neighbors)):
+                self._nbrs_epoch += 1
+            first_hop_neighbor_info[TWO_HOP] = two_hop_neighbors
+            nbrs_awaiting_info = self._nbrs_awaiting_info
 
         # the node checks dominance only when it has received all
         # two-neighbor info
-        for nbr_mac in self.nbrs_dict.keys():
-            if self.nbrs_dict[nbr_mac][1] is None:
-                return
+        if nbrs_awaiting_info:
+            return
 
         if packet_type == NEIGHBOR_SET:
-            print("Received the last nbr set")
+            if DEBUG:
+                print("Received the last nbr set")
             self.__check_dominance()
 
         # if nbr sent out an updated nbr set, then the delayed dominance check
@@ -527,11 +658,12 @@ class CDS:
         # is likely that my others nbrs will also update their sets.
         if (packet_type == UPD_NEIGHBOR_SET and
                 self.alarm_check_dominance == None):
-            print("Received updated nbr set, setting alarm to check dominance")
+            if DEBUG:
+                print("Received updated nbr set, setting alarm to check dominance")
             self.alarm_check_dominance = tim.init(period=60 * 1000, mode=Timer.ONE_SHOT, callback=self.__check_dominance_alarm )
 
     def get_is_dominant(self):
-        return self.is_dominant
+        return self.is_dominator
 
 
 
@@ -541,6 +673,11 @@ class CDS:
 #                                   *
 #************************************
 
+# 4 bytes header checksum of a text packet, computed over id and hop limit
+@micropython.native
+def header_checksum(id, hop_limit):
+    return crc32(id + bytes([hop_limit])).to_bytes(4, "big")
+
 # sends message by LoRa
 # generates id's for messages
 def send_text_lora(msg, cds):
@@ -548,51 +685,48 @@ def send_text_lora(msg, cds):
     packet_type = bytes([TEXT_MESSAGE])
 
     # creating 4 bytes id for message
-    id = os.urandom(32)
-    print("Generated id:", id)
-    print("id type", type(id))
+    id = os.urandom(4)
+    if DEBUG:
+        print("Generated id:", id)
+        print("id type", type(id))
     message_ids.append(id)
-    while len(message_ids) > 100:
-        message_ids.pop(0)
 
     # setting 1 byte hop limit for packet
-    hop_limit = bytes([3])
+    hop_limit = 3
 
     # calculating 4 bytes header checksum for packet
-    cks = sha256(id + hop_limit)
-    cks = cks.digest()
-    cks = hexlify(cks)
-    cks = cks.decode()[:4]
+    cks = header_checksum(id, hop_limit)
 
-    packet = packet_type + id + hop_limit + cks + msg
+    packet = packet_type + id + bytes([hop_limit]) + cks + msg
 
     lora.send(packet)
     global num_sent_pkts
     num_sent_pkts += 1
-    print("Sent packet of length", len(packet), "with text", packet)
+    if DEBUG:
+        print("Sent packet of length", len(packet), "with text", packet)
     show_on_screen("sent packet", cds)
 
 def process_text_message(recv_pkg, cds):
     global num_rcvd_pkts
+    global num_log_writes
     num_rcvd_pkts += 1
     show_on_screen("rcvd packet", cds)
-    id = recv_pkg[1:5]
+    id = bytes(recv_pkg[1:5])
     hop_limit = recv_pkg[5]
-    checksum = recv_pkg[6:10]
-    msg = recv_pkg[10:]
+    checksum = bytes(recv_pkg[6:10])
+    msg = bytes(recv_pkg[10:])
 
     # calculating header checksum for comparison
-    cks = sha256(id + bytes([hop_limit]))
-    cks = cks.digest()
-    cks = hexlify(cks)
-    cks = cks[:4]
+    cks = header_checksum(id, hop_limit)
 
     if cks != checksum:
-        print("incorrect checksum")
-        print("calculated checksum", checksum)
-        print("given cks", cks)
+        log_event("incorrect checksum")
+        if DEBUG:
+            print("incorrect checksum")
+            print("calculated checksum", checksum)
+            print("given cks", cks)
         return
-    else:
+    elif DEBUG:
         print("correct checksum")
 
     if len(msg) > 0:
@@ -605,27 +739,22 @@ def process_text_message(recv_pkg, cds):
         if True:
             with lock:
                 messages.append(msg)
-                while len(messages) > 100:
-                    messages.pop(0)
                 message_ids.append(id)
-                while len(message_ids) > 100:
-                    message_ids.pop(0)
             # send to all connected via wifi
             # for client in websocket_clients:
             #     ws_send_message(client, msg)
 
-    if is_dominator and hop_limit > 0:
+    if node_is_dominant and hop_limit > 0:
         hop_limit -= 1
         # calculating new header checksum and forwarding the packet
-        new_cks = sha256(id + bytes([hop_limit]))
-        new_cks = new_cks.digest()
-        new_cks = hexlify(new_cks)
-        new_cks = new_cks.decode()[:4]
-        log = "I resent a packet of " + str(len(msg)) + " with text: " + msg + "\n"
-        print(log)
-        f = open("logs.txt", "a")
-        f.write(log)
-        f.close()
+        new_cks = header_checksum(id, hop_limit)
+        log = "I resent a packet of %d with text: %s\n" % (len(msg), msg.decode())
+        if DEBUG:
+            print(log)
+        log_file.write(log)
+        num_log_writes += 1
+        if num_log_writes % LOG_FLUSH_EVERY == 0:
+            log_file.flush()
         lora.send(bytes([TEXT_MESSAGE]) + id + bytes([hop_limit]) + new_cks + msg)
 
 def process_request_prev_msg(recv_pkg):
@@ -641,14 +770,17 @@ def receive_lora(event):
         global cds
         recv_pkg = None
         try:
-            recv_pkg, err = lora.recv()
+            recv_pkg, err = lora.recv(rx_buffer=rx_buf)
         except Exception as e:
-            print("exception ", e)
-        if recv_pkg is None or not isinstance(recv_pkg, bytes):
+            log_event("recv exception")
+            if DEBUG:
+                print("exception ", e)
+        if recv_pkg is None:
             return
         if len(recv_pkg) <= 0:
             return
-        print("Received packet of length", len(recv_pkg), "with text", recv_pkg)
+        if DEBUG:
+            print("Received packet of length", len(recv_pkg), "with text", bytes(recv_pkg))
 
         packet_type = recv_pkg[0]
         # no switch case in micropython(
@@ -663,10 +795,12 @@ def receive_lora(event):
         elif packet_type == REPLY_PREV_MSG:
             process_reply_prev_msg(recv_pkg)
         else:
-            print("wrong packet type")
+            if DEBUG:
+                print("wrong packet type")
             return
     elif event & SX1262.TX_DONE:
-        print('sent packet')
+        if DEBUG:
+            print('sent packet')
 
 
 #********************************
@@ -674,16 +808,14 @@ def receive_lora(event):
 #           Main Code           *
 #                               *
 #********************************
+# collect once a quarter of the free heap has been allocated, so that each
+# collection has less to do and comes before the heap runs out
+gc.threshold(gc.mem_free() // 4 + gc.mem_alloc())
+
 lora.setBlockingCallback(False, receive_lora)
 
 cds = CDS(lora)
-
-def sending_beacons():
-    while True:
-        time.sleep(3)
-        cds.send_beacon()
-
-_thread.start_new_thread(sending_beacons, ())
+cds.start_beacons()
 
 while True:
     # cds.__send_nbr_set(NEIGHBOR_SET)
@@ -0,0 +1,17 @@
+# Freezes LoRa Mesh CDS into the MicroPython firmware so that its bytecode
+# and string literals live in flash instead of the GC heap.
+# Build with (ESP32 port, from micropython/ports/esp32):
+#   make BOARD=ESP32_GENERIC_S3 FROZEN_MANIFEST=/path/to/LoRa-Mesh-CDS/manifest.py
+# The frozen main.py is run at boot even if a main.py exists on the board's
+# filesystem; such a copy is ignored, so reflash to change the application.
+
+include("$(PORT_DIR)/boards/manifest.py")
+
+# opt=3 strips asserts and __debug__ blocks from the frozen bytecode; the
+# LoRa driver reports every error through ASSERT(), so it keeps the default
+# optimisation level
+module("main.py", opt=3)
+module("ssd1306.py", opt=3)
+module("sx1262.py")
+module("sx126x.py")
+module("_sx126x.py")
@@ -92,7 +92,11 @@ class SSD1306(framebuf.FrameBuffer):
         self.write_cmd(SET_COM_OUT_DIR | ((rotate & 1) << 3))
         self.write_cmd(SET_SEG_REMAP | (rotate & 1))
 
-    def show(self):
+    # pushes the framebuffer to the display; page_start/page_end (inclusive)
+    # limit the transfer to the given range of 8-pixel rows
+    def show(self, page_start=0, page_end=None):
+        if page_end is None:
+            page_end = self.pages - 1
         x0 = 0
         x1 = self.width - 1
         if self.width != 128:
@@ -104,9 +108,12 @@ class SSD1306(framebuf.FrameBuffer):
         self.write_cmd(x0)
         self.write_cmd(x1)
         self.write_cmd(SET_PAGE_ADDR)
-        self.write_cmd(0)
-        self.write_cmd(self.pages - 1)
-        self.write_data(self.buffer)
+        self.write_cmd(page_start)
+        self.write_cmd(page_end)
+        if page_start == 0 and page_end == self.pages - 1:
+            self.write_data(self.buffer)
+        else:
+            self.write_data(memoryview(self.buffer)[page_start * self.width:(page_end + 1) * self.width])
 
 
 class SSD1306_I2C(SSD1306):
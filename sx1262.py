@@ -174,9 +174,9 @@ class SX1262(SX126X):
             super().clearDio1Action()
             return state
 
-    def recv(self, len=0, timeout_en=False, timeout_ms=0):
+    def recv(self, len=0, timeout_en=False, timeout_ms=0, rx_buffer=None):
         if not self.blocking:
-            return self._readData(len)
+            return self._readData(len, rx_buffer)
         else:
             return self._receive(len, timeout_en, timeout_ms)
 
@@ -224,7 +224,7 @@ class SX1262(SX126X):
         state = super().transmit(data, len(data))
         return len(data), state
 
-    def _readData(self, len_=0):
+    def _readData(self, len_=0, rx_buffer=None):
         state = ERR_NONE
 
         length = super().getPacketLength()
@@ -232,7 +232,12 @@ class SX1262(SX126X):
         if len_ < length and len_ != 0:
             length = len_
 
-        data = bytearray(length)
+        if rx_buffer is None:
+            data = bytearray(length)
+        else:
+            if length > len(rx_buffer):
+                length = len(rx_buffer)
+            data = rx_buffer
         data_mv = memoryview(data)
 
         try:
@@ -243,7 +248,9 @@ class SX1262(SX126X):
         ASSERT(super().startReceive())
 
         if state == ERR_NONE or state == ERR_CRC_MISMATCH:
-            return bytes(data), state
+            if rx_buffer is None:
+                return bytes(data), state
+            return data_mv[:length], state
 
         else:
             return b'', state